@@ -11,7 +11,7 @@ if __name__ == "__main__":
         "openai_api_key": "",  # 替换为你的密钥
         "stable_api_url": "",  # 你的SD WebUI地址
         "sd_model_checkpoint": "[C站热门|真人]麦橘v6.safetensors",  # 你的SD模型名称
-        "concurrent_workers": 1,   # 1个并发线程
+        "concurrent_workers": 1,   # OpenAI和SD各1个并发请求（两阶段可重叠，共2个工作线程）
         #命脉：角色-相貌提示词字典
         "character_prompts": {
             "I": "black eyes, tall and straight stature, sharp and cold eyebrows, plain cheap casual wear in early stage, handmade high-end suit with Patek Philippe watch in later stage, powerful and calm aura, faint mocking smile when facing enemies, hoarse voice when questioning in grief",
@@ -1,40 +1,188 @@
 # 导入基础库
-import json          # 用于处理JSON数据（SD API返回结果解析）
+import json          # JSON解析的回退实现（未安装orjson时解析SD API返回结果）
 import requests      # 用于发送HTTP请求（调用SD WebUI API）
 import io            # 用于处理字节流（图片数据解码）
-import base64        # 用于解码SD返回的base64格式图片
-import threading     # 线程基础库（备用）
+import binascii      # 用于解码SD返回的base64格式图片（直接调用C实现的解码器）
+import threading     # 线程锁/信号量（共享客户端、文档、txt句柄、缓存的并发保护及API并发限制）
 import random        # 用于随机选择图片宽高
 import os            # 用于文件路径、目录操作
 import shutil        # 用于复制文档文件
 import time          # 用于重试机制的延时
+import functools     # 用于缓存tiktoken编码器
+import logging       # 工作线程日志输出（替代print，避免多线程争用stdout）
+import sys           # 日志输出到标准输出
+import socket        # 设置SD连接的TCP套接字选项
+import hashlib       # 计算文本块摘要（提示词去重缓存的键）
+import contextlib    # 按需启用日志重定向的上下文管理器
 from typing import List, Dict, Optional, Tuple  # 类型注解（提升代码可读性和健壮性）
-from concurrent.futures import ThreadPoolExecutor  # 线程池（并发处理文本块）
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed  # 线程池（并发处理文本块）+按完成顺序获取结果+提示词缓存占位
+from requests.adapters import HTTPAdapter  # HTTP连接池适配器（复用SD API的长连接）
+from urllib3.connection import HTTPConnection  # 读取urllib3默认的套接字选项
 
 # 导入第三方库
-from PIL import Image               # 用于处理图片（保存SD生成的图片）
 from docx import Document           # 用于读写docx文档（核心）
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT  # 用于设置段落对齐方式（图片/文字居中）
 from docx.shared import Inches      # 用于控制插入文档的图片尺寸
+from docx.oxml.ns import qn         # 用于拼接带命名空间的XML标签名（直接解析段落XML）
 import tiktoken                     # OpenAI官方Token计算库（分割文本块）
+from tqdm import tqdm               # 进度条（显示文本块处理进度）
+from tqdm.contrib.logging import logging_redirect_tqdm  # 进度条显示期间通过tqdm.write输出日志
 from openai import OpenAI           # OpenAI Python客户端（调用文字API）
 from openai import APIError, APITimeoutError  # OpenAI异常类（捕获API错误）
 
+# 可选依赖：orjson解析SD返回的大体积JSON（含base64图片）更快，未安装时回退到标准库json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 模块日志对象（由run()通过_configure_logger配置输出，不修改全局/根日志配置）
+logger = logging.getLogger(__name__)
+
+def _configure_logger():
+    """
+    为模块日志对象挂载输出到标准输出的处理器（只挂载一次）：
+    - 仅配置本模块的logger，不调用logging.basicConfig，避免开启httpx等第三方库的INFO日志
+    - 调用方已为本模块或根日志配置处理器时不做任何修改
+    """
+    if logger.hasHandlers():
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+
+# ========== SD连接池适配器 ==========
+class _KeepAliveHTTPAdapter(HTTPAdapter):
+    """
+    为连接池中的每个连接设置TCP选项的HTTPAdapter：
+    - TCP_NODELAY：关闭Nagle算法，小的JSON请求不必等待合包（沿用urllib3默认选项）
+    - SO_KEEPALIVE：长时间空闲（等待SD出图）的连接不会被中间网络设备静默断开
+    """
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.socket_options)
+        super().init_poolmanager(*args, **kwargs)
+
+# ========== Token编码器缓存（独立函数） ==========
+@functools.lru_cache(maxsize=4)
+def _get_encoder(model_name: str) -> "tiktoken.Encoding":
+    """
+    获取指定模型的tiktoken编码器（进程内只加载一次BPE词表）
+    :param model_name: OpenAI模型名称
+    :return: 对应的Token编码器
+    """
+    return tiktoken.encoding_for_model(model_name)
+
+# ========== 段落文本提取（独立函数） ==========
+# 段落中需要转换为文本的run子元素标签（与python-docx的Paragraph.text规则一致）
+_W_T = qn("w:t")
+_W_TAB_TAGS = (qn("w:tab"), qn("w:ptab"))
+_W_BR = qn("w:br")
+_W_CR = qn("w:cr")
+_W_NO_BREAK_HYPHEN = qn("w:noBreakHyphen")
+_W_TYPE = qn("w:type")
+
+def _paragraph_text(p) -> str:
+    """
+    直接从w:p元素提取段落文本，结果与python-docx的Paragraph.text一致：
+    - 只遍历段落直属run及超链接内的run（不进入文本框，避免AlternateContent的Choice/Fallback重复提取）
+    - w:t取文本，w:tab/w:ptab转为"\t"，w:br（换行类型）/w:cr转为"\n"，w:noBreakHyphen转为"-"
+    :param p: 段落XML元素（w:p）
+    :return: 段落文本
+    """
+    parts = []
+    for child in p.xpath("./w:r/* | ./w:hyperlink/w:r/*"):
+        tag = child.tag
+        if tag == _W_T:
+            parts.append(child.text or "")
+        elif tag in _W_TAB_TAGS:
+            parts.append("\t")
+        elif tag == _W_CR:
+            parts.append("\n")
+        elif tag == _W_BR:
+            # 分页符/分栏符不产生文本，仅普通换行（默认类型）转为换行符
+            if child.get(_W_TYPE, "textWrapping") == "textWrapping":
+                parts.append("\n")
+        elif tag == _W_NO_BREAK_HYPHEN:
+            parts.append("-")
+    return "".join(parts)
+
+# PNG文件签名（校验SD返回的图片数据确为PNG，才能直接保存为.png并插入文档）
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# ========== 可重试异常判定（独立函数） ==========
+# 默认可重试的异常类型：网络超时/连接失败，以及HTTP状态错误（需再按状态码判定）
+RETRYABLE_EXCEPTIONS: Tuple[type, ...] = (
+    APITimeoutError,
+    APIError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.HTTPError,
+)
+
+def _find_retryable_exception(exc: BaseException, retry_on: Tuple[type, ...]) -> Optional[BaseException]:
+    """
+    沿异常链（__cause__/__context__）查找可重试的原始异常
+    - 业务方法会把底层异常包装成通用Exception，因此需要回溯异常链
+    - 带HTTP状态码的异常仅在429（限流）或5xx（服务端错误）时可重试
+    :param exc: 捕获到的异常
+    :param retry_on: 可重试的异常类型元组
+    :return: 可重试的原始异常，不可重试时返回None
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, retry_on):
+            # 兼容OpenAI（status_code属性）和requests（response.status_code）两种异常
+            status = getattr(exc, "status_code", None)
+            if status is None:
+                status = getattr(getattr(exc, "response", None), "status_code", None)
+            if status is None or status == 429 or status >= 500:
+                return exc
+            return None
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+def _get_retry_after(exc: BaseException) -> Optional[float]:
+    """
+    读取异常响应中的Retry-After响应头（秒），不存在、无法解析或为负数时返回None
+    :param exc: 可重试的原始异常
+    :return: 服务端建议的等待秒数
+    """
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after = float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+    # 负数（或NaN）无意义，且会让time.sleep抛出异常，忽略后改用指数退避
+    return retry_after if retry_after >= 0 else None
+
 # ========== 通用重试装饰器（独立函数） ==========
-def retry_decorator(retry_attr: str = "retry_times"):
+def retry_decorator(retry_attr: str = "retry_times", retry_on: Tuple[type, ...] = RETRYABLE_EXCEPTIONS):
     """
     【装饰器功能阐述】
     通用重试装饰器，专为类实例方法设计，实现API调用失败后的自动重试逻辑：
     - 从类实例中读取重试次数配置（默认读取retry_times属性）
-    - 每次失败后延时1秒再重试
+    - 仅对网络超时/连接失败/429/5xx等临时错误重试，其余错误（如401、参数错误）直接抛出
+    - 每次失败后按指数退避+随机抖动延时（最长60秒），优先遵循服务端的Retry-After
     - 重试次数用尽后抛出最终异常
     - 仅适配Doc2ImageGenerator类的实例方法
     
     :param retry_attr: 类实例中存储重试次数的属性名，默认"retry_times"
+    :param retry_on: 可重试的异常类型元组，默认RETRYABLE_EXCEPTIONS
     """
     # 外层装饰器接收参数，返回内层装饰器
     def decorator(func):
         # 内层装饰器接收被装饰函数，返回包装函数
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             # 从被装饰函数的参数中获取类实例（第一个参数是self）
             self = args[0] if args else None
@@ -52,12 +200,20 @@ def retry_decorator(retry_attr: str = "retry_times"):
                     # 执行原函数，返回结果（正常情况直接返回）
                     return func(*args, **kwargs)
                 except Exception as e:
+                    # 不可重试的错误（永久性错误）直接抛出，避免无意义的等待
+                    retryable = _find_retryable_exception(e, retry_on)
+                    if retryable is None:
+                        raise
                     # 捕获异常，记录最后一次异常
                     last_exception = e
-                    # 如果还有重试次数，打印提示并延时
+                    # 如果还有重试次数，打印提示并延时（指数退避+抖动）
                     if attempt < retry_times:
-                        print(f"第{attempt+1}次调用失败，{e}，{retry_times - attempt}次重试机会...")
-                        time.sleep(1)
+                        delay = _get_retry_after(retryable)
+                        if delay is None:
+                            delay = 2 ** attempt + random.random()
+                        delay = max(0.0, min(60, delay))
+                        logger.warning(f"第{attempt+1}次调用失败，{e}，{delay:.1f}秒后重试，剩余{retry_times - attempt}次重试机会...")
+                        time.sleep(delay)
                     else:
                         # 重试次数用尽，抛出最终异常（保留异常溯源）
                         raise Exception(f"重试{retry_times}次后仍失败：{e}") from last_exception
@@ -84,6 +240,26 @@ class Doc2ImageGenerator:
     - 输出逻辑：图片插入docx，提示词保存到txt（文档同级目录）
     - 新增功能：支持用户指定输出目录，自动创建不存在的目录
     """
+    # OpenAI基础提示词模板（类常量，避免每个文本块重复构造）
+    _BASE_PROMPT_TEMPLATE = """
+        请你协助完成Stable Diffusion文生图提示词生成任务，严格遵循以下引导和规则：
+        
+        1. 先理解文本切片：仔细阅读下方提供的文本切片内容，重点关注切片最接近末尾的描述部分——这是你需要生成提示词的核心依据；
+        2. 场景选取要求：仅从切片最末尾的描述中，挑选1个具体、完整的场景（无需考虑前文内容，聚焦最后一个可视觉化的场景）；
+        3. 提示词生成规则：
+        - 必须用英文编写，以逗号分隔关键词/短语，仅保留表象化描述（如人物动作、服饰、环境、光影、物体形态等可直接视觉呈现的内容）；
+        - 坚决拒绝包含情感、心理活动、抽象概念类词汇（如"happy"、"sad"、"brave"等）；
+        - 提示词头部必须强制添加品质提升关键词：(masterpiece, best quality), beautiful detailed eyes, perfect face, detailed hair；
+        - 你需要根据我所提供的所有样貌提示词结合你选择的画面中应该出现的人物，识别对应角色相貌提示词追加在提示词的适当位置来保证人物一致性，与其他关键词用逗号分隔；
+        4. 输出要求：仅返回最终的提示词文本(请注意，提示词使用逗号分隔语言为英文)，无需任何额外解释、说明或格式修饰，确保可以直接用于Stable Diffusion生成图片。
+        5.提示词使用逗号分隔语言为英文
+
+        文本切片内容：
+        {chunk_content}
+
+        所有角色相貌提示词（追加到末尾）：{all_character_prompts}
+        """
+
     def __init__(
         self,
         docx_path: str,
@@ -107,7 +283,10 @@ class Doc2ImageGenerator:
         openai_timeout: float = 130.0,    # OpenAI API超时时间（默认130s）
         sd_timeout: float = 130.0,        # SD API超时时间（默认130s）
         retry_times: int = 2,             # API调用失败重试次数（默认2次）
-        output_dir: Optional[str] = None  # 新增：用户指定的输出目录（默认None，使用原文档目录）
+        output_dir: Optional[str] = None,  # 新增：用户指定的输出目录（默认None，使用原文档目录）
+        openai_concurrency: Optional[int] = None,  # OpenAI API最大并发数（默认None，等于concurrent_workers）
+        sd_concurrency: Optional[int] = None,      # SD API最大并发数（默认None，等于concurrent_workers）
+        save_images_to_disk: bool = True           # 是否额外把生成的图片保存到输出目录（图片始终直接插入文档）
     ):
         """
         【初始化方法功能阐述】
@@ -125,7 +304,8 @@ class Doc2ImageGenerator:
         :param openai_api_key: OpenAI API密钥（必填）
         :param stable_api_url: Stable WebUI API地址，默认本地http://127.0.0.1:7860
         :param sd_model_checkpoint: SD模型名称（如v1-5-pruned.ckpt，必填）
-        :param concurrent_workers: 并发线程数，默认2（避免API过载）
+        :param concurrent_workers: 每个服务（OpenAI/SD）的默认最大并发请求数，默认2（避免API过载）；
+            未单独指定openai_concurrency/sd_concurrency时两者都取该值，线程池大小为两者之和
         :param character_prompts: 角色-相貌提示词字典（全量传递）
         :param negative_prompt: 反向提示词（控制图片不生成的内容）
         :param CLIP_stop_at_last_layers: CLIP层数（SD参数）
@@ -140,6 +320,9 @@ class Doc2ImageGenerator:
         :param sd_timeout: SD API超时时间（秒）
         :param retry_times: API调用失败重试次数
         :param output_dir: 输出目录（副本文档/图片/提示词txt保存路径），默认None（使用原文档目录）
+        :param openai_concurrency: OpenAI API同时进行的最大请求数，默认None（等于concurrent_workers）
+        :param sd_concurrency: SD API同时进行的最大请求数，默认None（等于concurrent_workers）
+        :param save_images_to_disk: 是否把图片另存为PNG文件到输出目录，默认True；False时图片仅存在于文档中
         """
         # 基础文档参数（保存到实例属性）
         self.docx_path = docx_path
@@ -150,8 +333,17 @@ class Doc2ImageGenerator:
         self.openai_api_key = openai_api_key
         # 角色提示词字典：如果传入None则初始化为空字典
         self.character_prompts = character_prompts if character_prompts is not None else {}
+        # 全量角色提示词（初始化后不再变化，只拼接一次）
+        self._all_character_prompt = self._get_all_character_prompts()
         self.openai_timeout = openai_timeout
         self.retry_times = retry_times
+        # OpenAI客户端：首次使用时创建并在所有文本块间复用（共享HTTPX连接池）
+        self._openai_client = None
+        self._openai_client_lock = threading.Lock()
+        # 提示词缓存：内容相同的文本块只调用一次OpenAI（键为规范化文本的摘要，值为生成结果的Future，
+        # 同内容文本块并发处理时后到者等待先到者的结果，而不是重复调用API）
+        self._prompt_cache: Dict[bytes, Future] = {}
+        self._prompt_cache_lock = threading.Lock()
         
         # Stable WebUI API参数（保存到实例属性）
         self.stable_api_url = stable_api_url
@@ -165,9 +357,39 @@ class Doc2ImageGenerator:
         self.seed = seed
         self.restore_faces = restore_faces
         self.sd_timeout = sd_timeout
+        self.save_images_to_disk = save_images_to_disk
+        # SD txt2img请求参数模板（固定参数只构造一次，每次请求浅拷贝后填入提示词和宽高）
+        # 模型/VAE/CLIP层数在run()开始时通过_apply_sd_options统一设置，不放入请求参数
+        self._sd_payload_template = {
+            "negative_prompt": self.negative_prompt,  # 反向提示词
+            "steps": self.steps,               # 采样步数
+            "sampler_name": self.sampler_name, # 采样器
+            "batch_size": self.batch_size,     # 批次大小
+            "n_iter": self.n_iter,             # 迭代次数
+            "seed": self.seed,                 # 随机种子
+            "restore_faces": self.restore_faces,  # 面部修复
+        }
         
-        # 并发配置（线程池最大工作数）
+        # 并发配置（每个服务的默认最大并发请求数）
         self.concurrent_workers = concurrent_workers
+        # 分服务并发配置：OpenAI与SD各自限流，两个阶段可以流水线重叠执行
+        self.openai_concurrency = openai_concurrency if openai_concurrency is not None else concurrent_workers
+        self.sd_concurrency = sd_concurrency if sd_concurrency is not None else concurrent_workers
+        if self.openai_concurrency < 1 or self.sd_concurrency < 1:
+            raise ValueError("openai_concurrency和sd_concurrency必须≥1")
+        self._openai_semaphore = threading.Semaphore(self.openai_concurrency)
+        self._sd_semaphore = threading.Semaphore(self.sd_concurrency)
+
+        # SD API会话：复用keep-alive连接，避免每张图片都重新进行TCP/TLS握手
+        # 连接池大小与SD并发数一致，保证每个SD请求都有可复用的连接
+        self._sd_session = requests.Session()
+        sd_adapter = _KeepAliveHTTPAdapter(
+            pool_connections=self.sd_concurrency,
+            pool_maxsize=self.sd_concurrency,
+            max_retries=0  # 重试由retry_decorator统一处理
+        )
+        self._sd_session.mount("http://", sd_adapter)
+        self._sd_session.mount("https://", sd_adapter)
         
         # 宽高列表处理：设置默认值，校验最小尺寸≥512
         if width_height_list is None:
@@ -184,6 +406,15 @@ class Doc2ImageGenerator:
         
         # 副本文档路径初始化（后续复制文档时赋值）
         self.docx_copy_path = None
+        # 内存中的副本文档：读取时打开一次，所有图片插入完成后统一保存一次
+        self._doc = None
+        self._doc_paragraphs = None  # 插入图片前的正文段落XML元素快照（段落索引→插入锚点）
+        self._doc_tables = None  # 插入图片前的正文表格XML元素快照（表格索引→插入锚点）
+        self._anchored_images = {}  # 每个锚点后已插入的图片（按文本块索引排序），保证图片顺序确定
+        self._doc_lock = threading.Lock()  # 多线程修改文档时加锁
+        # 提示词txt文件句柄：run()中打开一次，所有文本块共用（带缓冲），结束时关闭
+        self._txt_handle = None
+        self._txt_lock = threading.Lock()  # 多线程写入txt时加锁
 
         # ========== 新增：输出目录处理 ==========
         self.output_dir = output_dir
@@ -196,6 +427,10 @@ class Doc2ImageGenerator:
             # 使用原文档目录
             self.output_dir = os.path.dirname(self.docx_path)
 
+        # 缓存文档路径的各部分（文件名主干/扩展名/提示词txt路径），避免每个文本块重复解析路径
+        self._doc_stem, self._doc_ext = os.path.splitext(os.path.basename(self.docx_path))
+        self._txt_path = os.path.join(self.output_dir, f"{self._doc_stem}_prompts.txt")
+
         # 校验必填参数（防止运行时出错）
         if not self.openai_api_key:
             raise ValueError("OpenAI API密钥不能为空！")
@@ -212,7 +447,7 @@ class Doc2ImageGenerator:
         - 遍历character_prompts字典的所有值（角色对应的相貌提示词）
         - 用逗号+空格拼接所有提示词（符合SD提示词格式）
         - 空字典返回空字符串，避免传递无效内容
-        - 打印拼接后的提示词，方便调试
+        - 以debug级别记录拼接后的提示词，方便调试（仅在初始化时调用一次）
         
         :return: 拼接后的全量角色提示词（空字典返回空字符串）
         """
@@ -221,36 +456,52 @@ class Doc2ImageGenerator:
             return ""
         # 拼接所有角色提示词的值（忽略键），用逗号分隔
         all_prompts = ", ".join(self.character_prompts.values())
-        # 打印调试信息，方便查看传递的角色提示词
-        print(f"全量角色提示词：{all_prompts}")
+        # 记录调试信息，方便查看传递的角色提示词
+        logger.debug(f"全量角色提示词：{all_prompts}")
         return all_prompts
 
+    # ========== 私有方法：获取共享的OpenAI客户端 ==========
+    def _get_openai_client(self) -> OpenAI:
+        """
+        【方法功能阐述】
+        获取复用的OpenAI客户端，避免每个文本块都重新创建HTTPX连接池和TLS上下文：
+        - 首次调用时创建客户端（加锁，防止多个工作线程重复创建）
+        - 超时时间在客户端级别设置，SDK内置重试关闭（由retry_decorator统一处理）
+        
+        :return: 共享的OpenAI客户端实例
+        """
+        if self._openai_client is None:
+            with self._openai_client_lock:
+                # 二次判断：等待锁期间可能已被其他线程创建
+                if self._openai_client is None:
+                    self._openai_client = OpenAI(
+                        api_key=self.openai_api_key,
+                        base_url=self.openai_api_base,
+                        timeout=self.openai_timeout,
+                        max_retries=0
+                    )
+        return self._openai_client
+
     # ========== 私有方法：复制原文档生成副本（适配输出目录） ==========
     def _copy_docx_to_copy(self) -> str:
         """
         【方法功能阐述】
         复制原文档到输出目录生成副本，避免修改原文档：
-        - 解析原文档的文件名、扩展名
+        - 使用初始化时解析好的原文档文件名、扩展名
         - 生成副本文件名：原文件名+_copy+扩展名
         - 副本保存到用户指定的输出目录（而非原文档目录）
-        - 用shutil.copy2复制文件（保留元数据）
+        - 用shutil.copyfile复制文件内容（走系统零拷贝快速路径；副本随后会被改写，无需复制元数据）
         - 保存副本路径到实例属性，返回副本路径
         
         :return: 副本文档的完整路径
         """
-        # 解析原文档的文件名（含扩展名）
-        doc_name = os.path.basename(self.docx_path)
-        # 拆分文件名和扩展名
-        doc_name_no_ext = os.path.splitext(doc_name)[0]
-        doc_ext = os.path.splitext(doc_name)[1]
-        
         # 生成副本文件名：原文件名_copy.扩展名
-        copy_name = f"{doc_name_no_ext}_copy{doc_ext}"
+        copy_name = f"{self._doc_stem}_copy{self._doc_ext}"
         # 拼接副本的完整路径（使用输出目录）
         self.docx_copy_path = os.path.join(self.output_dir, copy_name)
         
-        # 复制原文档到副本路径（copy2保留文件元数据）
-        shutil.copy2(self.docx_path, self.docx_copy_path)
+        # 复制原文档到副本路径（仅复制内容，Linux下使用os.sendfile）
+        shutil.copyfile(self.docx_path, self.docx_copy_path)
         # 打印提示信息
         print(f"已复制原文档到输出目录副本：{self.docx_copy_path}")
         
@@ -263,6 +514,8 @@ class Doc2ImageGenerator:
         【方法功能阐述】
         读取副本文档的正文内容（排除空段落、页眉页脚）：
         - 优先使用已生成的副本，未生成则先复制
+        - 打开的文档保留在内存中（self._doc），供后续插入图片复用，避免重复解析
+        - 直接用XPath查询底层XML树提取文本，跳过python-docx对象模型（大文档提速明显）
         - 遍历文档所有段落，保留非空段落（记录段落索引和内容）
         - 遍历文档所有表格，保留非空单元格（记录单元格位置和内容）
         - 拼接所有内容为完整文本，校验非空
@@ -273,8 +526,16 @@ class Doc2ImageGenerator:
         # 如果副本路径未初始化，先复制文档生成副本
         if self.docx_copy_path is None:
             self._copy_docx_to_copy()
-        # 打开副本文档
+        # 打开副本文档（保留在内存中，后续插入图片和保存都复用该对象）
         doc = Document(self.docx_copy_path)
+        self._doc = doc
+        # 正文XML元素（w:body），后续直接用XPath查询，不创建Paragraph/Cell等包装对象
+        body = doc.element.body
+        # 段落快照：仅取正文直接子段落（与doc.paragraphs顺序一致），段落索引与插入锚点一一对应
+        self._doc_paragraphs = body.xpath("./w:p")
+        # 表格快照：表格文本块的图片插入到对应表格之后
+        self._doc_tables = body.xpath("./w:tbl")
+        self._anchored_images = {}
         
         # 存储所有非空内容（用于拼接完整文本）
         content = []
@@ -282,9 +543,9 @@ class Doc2ImageGenerator:
         paragraph_list = []
         
         # 遍历所有段落（排除空段落）
-        for para_idx, para in enumerate(doc.paragraphs):
-            # 去除首尾空格，判断是否为空
-            para_text = para.text.strip()
+        for para_idx, para in enumerate(self._doc_paragraphs):
+            # 提取段落文本（保留换行/制表符），去除首尾空格，判断是否为空
+            para_text = _paragraph_text(para).strip()
             if para_text:
                 # 添加到内容列表
                 content.append(para_text)
@@ -293,11 +554,11 @@ class Doc2ImageGenerator:
         
         # 遍历所有表格（处理表格中的文本）
         table_paragraphs = []
-        for table_idx, table in enumerate(doc.tables):
-            for row_idx, row in enumerate(table.rows):
-                for cell_idx, cell in enumerate(row.cells):
-                    # 去除首尾空格，判断是否为空
-                    cell_text = cell.text.strip()
+        for table_idx, table in enumerate(self._doc_tables):
+            for row_idx, row in enumerate(table.xpath("./w:tr")):
+                for cell_idx, cell in enumerate(row.xpath("./w:tc")):
+                    # 单元格内各段落换行拼接，去除首尾空格，判断是否为空
+                    cell_text = "\n".join(_paragraph_text(p) for p in cell.xpath("./w:p")).strip()
                     if cell_text:
                         # 添加到内容列表
                         content.append(cell_text)
@@ -327,28 +588,29 @@ class Doc2ImageGenerator:
         :param paragraph_list: 段落/表格内容列表
         :return: 分割后的文本块列表（每个块是字典）
         """
-        # 获取gpt-3.5-turbo的Token编码规则（精准计算Token数）
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        # 获取gpt-3.5-turbo的Token编码规则（缓存的编码器，只加载一次）
+        encoding = _get_encoder("gpt-3.5-turbo")
+        # 批量编码所有段落（多线程并行），只保留每个段落的Token数量（不保存Token列表）
+        token_counts = [
+            len(tokens) for tokens in encoding.encode_batch(
+                [p[1] for p in paragraph_list],
+                num_threads=os.cpu_count() or 1
+            )
+        ]
         
         # 存储分割后的文本块
         chunks = []
-        # 存储当前块的Token列表（临时）
-        current_chunk_tokens = []
         # 存储当前块的段落列表（临时）
         current_chunk_paragraphs = []
         # 存储当前块的Token总数（临时）
         current_token_count = 0
         
         # 遍历所有段落/表格单元格
-        for para_idx, para_text in paragraph_list:
-            # 计算当前段落的Token列表和数量
-            para_tokens = encoding.encode(para_text)
-            para_token_count = len(para_tokens)
-            
+        for (para_idx, para_text), para_token_count in zip(paragraph_list, token_counts):
             # 如果添加当前段落会超过Token上限，且当前块已有内容：保存当前块，重置临时变量
             if current_token_count + para_token_count > self.token_per_chunk and current_token_count > 0:
                 # 拼接当前块的文本（换行分隔段落）
-                chunk_text = "\n".join([p[1] for p in current_chunk_paragraphs])
+                chunk_text = "\n".join(p[1] for p in current_chunk_paragraphs)
                 # 添加到文本块列表（记录文本、起始/结束索引、包含的段落）
                 chunks.append({
                     "text": chunk_text,
@@ -357,18 +619,16 @@ class Doc2ImageGenerator:
                     "paragraphs": current_chunk_paragraphs.copy()
                 })
                 # 重置临时变量，准备下一个块
-                current_chunk_tokens = []
                 current_chunk_paragraphs = []
                 current_token_count = 0
             
             # 将当前段落添加到临时块中
-            current_chunk_tokens.extend(para_tokens)
             current_chunk_paragraphs.append((para_idx, para_text))
             current_token_count += para_token_count
         
         # 处理最后一个块（循环结束后可能还有未保存的内容）
         if current_token_count > 0:
-            chunk_text = "\n".join([p[1] for p in current_chunk_paragraphs])
+            chunk_text = "\n".join(p[1] for p in current_chunk_paragraphs)
             chunks.append({
                 "text": chunk_text,
                 "start_idx": current_chunk_paragraphs[0][0],
@@ -394,40 +654,14 @@ class Doc2ImageGenerator:
         """
         # 提前初始化变量，避免未赋值问题
         final_prompt = ""
-        # 获取所有角色提示词（全量传递）
-        all_character_prompt = self._get_all_character_prompts()
-        
-        # 替换为你提供的新基础提示词模板
-        base_prompt_template = """
-        请你协助完成Stable Diffusion文生图提示词生成任务，严格遵循以下引导和规则：
-        
-        1. 先理解文本切片：仔细阅读下方提供的文本切片内容，重点关注切片最接近末尾的描述部分——这是你需要生成提示词的核心依据；
-        2. 场景选取要求：仅从切片最末尾的描述中，挑选1个具体、完整的场景（无需考虑前文内容，聚焦最后一个可视觉化的场景）；
-        3. 提示词生成规则：
-        - 必须用英文编写，以逗号分隔关键词/短语，仅保留表象化描述（如人物动作、服饰、环境、光影、物体形态等可直接视觉呈现的内容）；
-        - 坚决拒绝包含情感、心理活动、抽象概念类词汇（如"happy"、"sad"、"brave"等）；
-        - 提示词头部必须强制添加品质提升关键词：(masterpiece, best quality), beautiful detailed eyes, perfect face, detailed hair；
-        - 你需要根据我所提供的所有样貌提示词结合你选择的画面中应该出现的人物，识别对应角色相貌提示词追加在提示词的适当位置来保证人物一致性，与其他关键词用逗号分隔；
-        4. 输出要求：仅返回最终的提示词文本(请注意，提示词使用逗号分隔语言为英文)，无需任何额外解释、说明或格式修饰，确保可以直接用于Stable Diffusion生成图片。
-        5.提示词使用逗号分隔语言为英文
-
-        文本切片内容：
-        {chunk_content}
-
-        所有角色相貌提示词（追加到末尾）：{all_character_prompts}
-        """
-        
-        # 填充模板（包含全量角色提示词）
-        prompt_template = base_prompt_template.format(
+        # 填充模板（包含全量角色提示词，初始化时已拼接好）
+        prompt_template = Doc2ImageGenerator._BASE_PROMPT_TEMPLATE.format(
             chunk_content=chunk,
-            all_character_prompts=all_character_prompt
+            all_character_prompts=self._all_character_prompt
         )
         
-        # 初始化OpenAI客户端
-        client = OpenAI(
-            api_key=self.openai_api_key,
-            base_url=self.openai_api_base
-        )
+        # 获取复用的OpenAI客户端
+        client = self._get_openai_client()
         
         try:
             response = client.chat.completions.create(
@@ -437,8 +671,7 @@ class Doc2ImageGenerator:
                     {"role": "user", "content": prompt_template}
                 ],
                 temperature=0.7,
-                max_tokens=1000,
-                timeout=self.openai_timeout
+                max_tokens=1000
             )
             
             # 补充响应为空的校验
@@ -470,49 +703,65 @@ class Doc2ImageGenerator:
         
         return final_prompt
 
+    # ========== 私有方法：预先设置SD模型（带重试） ==========
+    @retry_decorator()
+    def _apply_sd_options(self):
+        """
+        【方法功能阐述】
+        在提交生成任务前，通过/sdapi/v1/options一次性设置SD WebUI的全局选项：
+        - 加载指定的SD模型、VAE模型，设置CLIP层数
+        - 固定API返回图片格式为PNG（服务端samples_format可能是jpg/webp，python-docx无法插入webp）
+        - 之后的txt2img请求不再携带override_settings，避免每次请求都校验/切换模型
+        - 该请求走同一个SD会话，同时起到预热连接池的作用（首个txt2img请求无需再握手）
+        - 装饰器自动处理重试逻辑
+        """
+        options = {
+            "sd_model_checkpoint": self.sd_model_checkpoint,  # 指定使用的SD模型
+            "sd_vae": "animevae.pt",                          # VAE模型（提升图片色彩）
+            "CLIP_stop_at_last_layers": self.CLIP_stop_at_last_layers,  # CLIP层数
+            "samples_format": "png",                          # 返回图片格式（直接插入文档/保存为.png）
+        }
+        try:
+            response = self._sd_session.post(
+                url=f"{self.stable_api_url}/sdapi/v1/options",
+                json=options,
+                timeout=self.sd_timeout
+            )
+            response.raise_for_status()
+        # 捕获超时异常，抛出自定义提示
+        except requests.exceptions.Timeout:
+            raise Exception(f"SD模型设置超时（超时时间：{self.sd_timeout}s）")
+        # 捕获请求异常（如连接失败、状态码错误）
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"SD模型设置失败：{e}")
+        print(f"SD模型已设置：{self.sd_model_checkpoint}")
+
     # ========== 私有方法：生成图片（适配输出目录） ==========
     @retry_decorator()
-    def _generate_image(self, prompt: str, chunk_index: int) -> str:
+    def _generate_image(self, prompt: str, chunk_index: int) -> Tuple[bytes, Optional[str]]:
         """
         【方法功能阐述】
-        调用Stable Diffusion WebUI API生成图片，保存到用户指定的输出目录：
+        调用Stable Diffusion WebUI API生成图片，返回内存中的图片数据：
         - 随机选择图片宽高（从width_height_list中）
-        - 构造SD API的请求参数（包含提示词、反向提示词、模型名等）
+        - 基于初始化时构造的参数模板，填入提示词和宽高得到请求参数
         - 发送POST请求调用txt2img接口（文生图）
-        - 解码base64格式的图片数据，保存为PNG文件
-        - 返回图片保存路径（输出目录）
+        - 解码base64格式的图片数据（SD返回的已是PNG字节，直接用于插入文档）
+        - 开启save_images_to_disk时，额外保存为PNG文件到输出目录
         - 装饰器自动处理重试逻辑
         
         :param prompt: SD提示词（去除textarea标签后的纯文本）
         :param chunk_index: 文本块索引（用于生成图片文件名）
-        :return: 图片保存的完整路径
+        :return: 元组(PNG图片字节, 图片保存的完整路径；未保存到磁盘时为None)
         """
+        # 构造SD API的请求参数：浅拷贝固定参数模板，只填入每次变化的字段
+        payload = self._sd_payload_template.copy()
+        payload["prompt"] = prompt  # 正向提示词
         # 随机选择图片宽高（从预设列表中）
-        width, height = random.choice(self.width_height_list)
-        
-        # 构造SD API的请求参数（严格匹配SD WebUI的txt2img接口要求）
-        payload = {
-            "override_settings": {
-                "sd_model_checkpoint": self.sd_model_checkpoint,  # 指定使用的SD模型
-                "sd_vae": "animevae.pt",                          # VAE模型（提升图片色彩）
-                "CLIP_stop_at_last_layers": self.CLIP_stop_at_last_layers,  # CLIP层数
-            },
-            "prompt": prompt,                  # 正向提示词
-            "negative_prompt": self.negative_prompt,  # 反向提示词
-            "steps": self.steps,               # 采样步数
-            "sampler_name": self.sampler_name, # 采样器
-            "width": width,                    # 图片宽度
-            "height": height,                  # 图片高度
-            "batch_size": self.batch_size,     # 批次大小
-            "n_iter": self.n_iter,             # 迭代次数
-            "seed": self.seed,                 # 随机种子
-            "CLIP_stop_at_last_layers": self.CLIP_stop_at_last_layers,
-            "restore_faces": self.restore_faces,  # 面部修复
-        }
+        payload["width"], payload["height"] = random.choice(self.width_height_list)
         
         try:
-            # 发送POST请求调用SD WebUI的txt2img接口
-            response = requests.post(
+            # 发送POST请求调用SD WebUI的txt2img接口（复用会话连接池）
+            response = self._sd_session.post(
                 url=f"{self.stable_api_url}/sdapi/v1/txt2img",  # API接口地址
                 json=payload,                                   # 请求体（JSON格式）
                 timeout=self.sd_timeout                         # 超时时间（秒）
@@ -520,21 +769,28 @@ class Doc2ImageGenerator:
             # 校验响应状态码（非200则抛出异常）
             response.raise_for_status()
             
-            # 解析JSON响应
-            result = response.json()
+            # 解析JSON响应（优先使用orjson直接解析原始字节）
+            result = _json_loads(response.content)
             # 解码base64格式的图片数据（SD返回的第一个图片）
-            image_data = base64.b64decode(result['images'][0])
-            # 用PIL打开字节流图片
-            image = Image.open(io.BytesIO(image_data))
+            # JSON解析得到的是str，先转为ASCII字节，再直接交给binascii解码（省去base64模块的额外处理）
+            image_b64 = result['images'][0]
+            if isinstance(image_b64, str):
+                image_b64 = image_b64.encode("ascii")
+            image_data = binascii.a2b_base64(image_b64)
+            # 校验图片格式：直接透传字节的前提是PNG（samples_format已在_apply_sd_options中设为png）
+            if not image_data.startswith(_PNG_SIGNATURE):
+                raise Exception("SD返回的图片不是PNG格式，请检查SD WebUI的samples_format设置")
             
-            # ========== 适配输出目录：图片保存到用户指定的输出目录 ==========
-            doc_name = os.path.splitext(os.path.basename(self.docx_path))[0]
-            image_path = os.path.join(self.output_dir, f"{doc_name}_chunk_{chunk_index}.png")
-            # 保存图片到输出目录
-            image.save(image_path)
+            # ========== 适配输出目录：按需把图片保存到用户指定的输出目录 ==========
+            image_path = None
+            if self.save_images_to_disk:
+                image_path = os.path.join(self.output_dir, f"{self._doc_stem}_chunk_{chunk_index}.png")
+                # 已校验为PNG数据，直接写入文件（无需解码再重新编码）
+                with open(image_path, "wb") as f:
+                    f.write(image_data)
             
-            # 返回图片路径
-            return image_path
+            # 返回图片字节和图片路径
+            return image_data, image_path
         
         # 捕获超时异常，抛出自定义提示
         except requests.exceptions.Timeout:
@@ -547,69 +803,107 @@ class Doc2ImageGenerator:
             raise Exception(f"生成图片失败（块{chunk_index}）：{str(e)}")
 
     # ========== 私有方法：写入文档+保存提示词（适配输出目录） ==========
-    def _write_to_docx(self, image_path: str, prompt: str, chunk: Dict, chunk_index: int):
+    def _write_to_docx(self, image_data: bytes, prompt: str, chunk: Dict, chunk_index: int):
         """
         【方法功能阐述】
         核心修改：仅在文档中插入居中的图片（移除所有引导词/提示词段落），提示词保存到输出目录的txt文件：
-        1. 提示词保存：追加到输出目录的txt文件（按文本块索引区分）
+        1. 提示词保存：通过run()中打开的共享句柄写入输出目录的txt文件（按文本块索引区分）
         2. 文档写入：仅在文本块后插入居中的图片，无任何引导文字
-        3. 支持段落/表格两种文本块类型，保留原文档结构
-        4. 保存修改后的文档（输出目录），返回副本路径
+        3. 支持段落/表格两种文本块类型：段落块插入到最后一个段落之后，表格块插入到所在表格之后
+        4. 同一锚点后有多张图片时按文本块索引排序，图片顺序与并发完成顺序无关
+        5. 只修改内存中的文档（加锁保证线程安全），由run()在全部完成后统一保存
         
-        :param image_path: 图片保存路径
+        :param image_data: PNG图片字节（直接插入文档，无需读取磁盘文件）
         :param prompt: 带textarea标签的提示词
         :param chunk: 文本块字典（包含起始/结束索引）
         :param chunk_index: 文本块索引
-        :return: 修改后的副本文档路径
+        :return: 副本文档路径
         """
-        # 打开副本文档
-        doc = Document(self.docx_copy_path)
-        
         # ========== 适配输出目录：提示词保存到输出目录的txt文件 ==========
-        doc_name = os.path.splitext(os.path.basename(self.docx_path))[0]
-        txt_path = os.path.join(self.output_dir, f"{doc_name}_prompts.txt")
-        with open(txt_path, "a", encoding="utf-8") as f:
-            f.write(f"===== 文本块 {chunk_index} 提示词 =====\n")
-            f.write(prompt.strip() + "\n\n")
+        with self._txt_lock:
+            self._txt_handle.write(f"===== 文本块 {chunk_index} 提示词 =====\n{prompt.strip()}\n\n")
         
         # 获取文本块的结束索引（用于确定插入位置）
         end_idx = chunk["end_idx"]
         
-        # 处理普通段落文本块（索引为整数）
-        if isinstance(end_idx, int):
-            # 计算插入位置：文本块结束索引+1（在文本块后插入内容）
-            insert_pos = end_idx + 1
-            if insert_pos > len(doc.paragraphs):
-                insert_pos = len(doc.paragraphs)
-            
+        with self._doc_lock:
             # 仅创建空段落用于插入图片（移除所有引导文字）
-            img_para = doc.add_paragraph()  # 空段落，无任何文字
-            img_run = img_para.add_run()
-            img_run.add_picture(image_path, width=Inches(6))  # 插入图片，宽度6英寸
+            img_para = self._doc.add_paragraph()  # 空段落，无任何文字
+            try:
+                img_run = img_para.add_run()
+                img_run.add_picture(io.BytesIO(image_data), width=Inches(6))  # 插入图片，宽度6英寸
+            except Exception:
+                # 图片无法插入（数据损坏/格式不支持）时移除刚追加的空段落，避免残留在共享文档末尾
+                img_para._element.getparent().remove(img_para._element)
+                raise
             img_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER  # 图片居中
             
-            # 段落移动函数（保留）
-            def move_paragraph(para, new_index):
-                doc._body._body.insert(new_index, para._element)
+            # 确定插入锚点：以原文档元素为锚点，其他文本块先后插入的图片不会影响位置
+            if isinstance(end_idx, int):
+                # 普通段落文本块（索引为整数）：文本块最后一个段落
+                para_idx = min(end_idx, len(self._doc_paragraphs) - 1)
+                anchor_key = ("p", para_idx)
+                anchor = self._doc_paragraphs[para_idx]
+            else:
+                # 表格文本块（索引格式table_{表格}_row_{行}_cell_{列}）：所在表格
+                table_idx = int(end_idx.split("_")[1])
+                anchor_key = ("tbl", table_idx)
+                anchor = self._doc_tables[table_idx]
             
-            # 仅移动图片段落到指定位置
-            move_paragraph(img_para, insert_pos)
-        
-        # 处理表格文本块（索引为字符串）
-        else:
-            # 仅创建空段落插入图片（无任何引导文字）
-            img_para = doc.add_paragraph()
-            img_run = img_para.add_run()
-            img_run.add_picture(image_path, width=Inches(6))
-            img_para.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-        
-        # 保存修改后的文档（输出目录）
-        doc.save(self.docx_copy_path)
+            # 同一锚点后的图片按文本块索引排序：插到最后一个索引更小的图片之后
+            placed = self._anchored_images.setdefault(anchor_key, [])
+            prev_element = anchor
+            insert_pos = 0
+            for placed_index, placed_element in placed:
+                if placed_index > chunk_index:
+                    break
+                prev_element = placed_element
+                insert_pos += 1
+            prev_element.addnext(img_para._element)
+            placed.insert(insert_pos, (chunk_index, img_para._element))
         
         # 打印提示信息
-        print(f"文本块{chunk_index}：提示词已保存到{txt_path}，图片已插入文档（仅保留图片，无引导词）")
+        logger.info(f"文本块{chunk_index}：提示词已保存到{self._txt_path}，图片已插入文档（仅保留图片，无引导词）")
         return self.docx_copy_path
 
+    # ========== 私有方法：获取SD提示词（带去重缓存） ==========
+    def _get_sd_prompt(self, chunk: str) -> str:
+        """
+        【方法功能阐述】
+        获取文本块的SD提示词，内容相同的文本块（忽略空白差异）只调用一次OpenAI：
+        - 以规范化文本的摘要为键查询缓存，命中时直接复用，不占用OpenAI并发名额
+        - 同内容文本块正在生成时，等待其结果而不是重复调用API
+        - 未命中时在OpenAI并发限制内调用_generate_sd_prompt（带重试）
+        - 生成失败时移除缓存占位（不缓存失败结果），正在等待的文本块同样收到该异常
+        
+        :param chunk: 单个文本块
+        :return: 纯文本格式的SD提示词
+        """
+        cache_key = hashlib.blake2b(" ".join(chunk.split()).encode("utf-8"), digest_size=16).digest()
+        with self._prompt_cache_lock:
+            future = self._prompt_cache.get(cache_key)
+            is_owner = future is None
+            if is_owner:
+                # 登记占位Future，后续同内容文本块等待该结果
+                future = Future()
+                self._prompt_cache[cache_key] = future
+        
+        if not is_owner:
+            logger.info("文本块内容与其他文本块相同，复用其提示词")
+            return future.result()
+        
+        try:
+            # 受OpenAI并发数限制
+            with self._openai_semaphore:
+                sd_prompt = self._generate_sd_prompt(chunk)
+        except Exception as e:
+            with self._prompt_cache_lock:
+                self._prompt_cache.pop(cache_key, None)
+            future.set_exception(e)
+            raise
+        future.set_result(sd_prompt)
+        return sd_prompt
+
     # ========== 私有方法：处理单个文本块 ==========
     def _process_single_chunk(self, chunk: Dict, chunk_index: int):
         """
@@ -617,23 +911,39 @@ class Doc2ImageGenerator:
         修正点：移除textarea标签替换逻辑，直接使用纯提示词
         """
         try:
-            print(f"开始处理文本块 {chunk_index}...")
+            logger.info(f"开始处理文本块 {chunk_index}...")
             
-            # 生成SD提示词（全量角色提示词，纯文本无标签）
-            sd_prompt = self._generate_sd_prompt(chunk["text"])
+            # 生成SD提示词（全量角色提示词，纯文本无标签），同内容文本块复用缓存，受OpenAI并发数限制
+            sd_prompt = self._get_sd_prompt(chunk["text"])
             # 移除多余的标签替换步骤，直接使用纯提示词
             pure_prompt = sd_prompt
             
-            # 生成图片（保存到输出目录）
-            image_path = self._generate_image(pure_prompt, chunk_index)
+            # 生成图片（保存到输出目录），受SD并发数限制
+            with self._sd_semaphore:
+                image_data, _ = self._generate_image(pure_prompt, chunk_index)
             
             # 插入图片+保存提示词（提示词保存到输出目录）
-            processed_doc = self._write_to_docx(image_path, sd_prompt, chunk, chunk_index)
+            processed_doc = self._write_to_docx(image_data, sd_prompt, chunk, chunk_index)
             
-            print(f"文本块 {chunk_index} 处理完成！副本文档：{processed_doc}")
+            logger.info(f"文本块 {chunk_index} 处理完成！副本文档：{processed_doc}")
         
         except Exception as e:
-            print(f"文本块 {chunk_index} 处理失败：{str(e)}")
+            logger.error(f"文本块 {chunk_index} 处理失败：{str(e)}")
+
+    # ========== 释放资源 ==========
+    def close(self):
+        """
+        【方法功能阐述】
+        释放生成器持有的网络资源：
+        - 关闭SD API会话，释放连接池中的所有连接
+        - 关闭已创建的OpenAI客户端
+        - run()结束时自动调用，可重复调用
+        """
+        self._sd_session.close()
+        with self._openai_client_lock:
+            if self._openai_client is not None:
+                self._openai_client.close()
+                self._openai_client = None
 
     # ========== 主执行方法 ==========
     def run(self):
@@ -643,12 +953,14 @@ class Doc2ImageGenerator:
         1. 复制原文档生成副本（保存到输出目录）
         2. 读取副本文档内容（段落+表格）
         3. 按Token数分割文本为多个块
-        4. 用线程池并发处理所有文本块（控制并发数）
-        5. 等待所有并发任务完成，打印最终结果路径（输出目录）
+        4. 用线程池并发处理所有文本块（OpenAI/SD分别控制并发数，两个阶段流水线重叠）
+        5. 等待所有并发任务完成，一次性保存文档，打印最终结果路径（输出目录）
         6. 捕获并抛出主流程异常
         
         执行流程：复制文档 → 读取内容 → 分割文本 → 并发处理 → 输出结果
         """
+        # 配置本模块日志输出（仅在调用方未配置日志时生效）
+        _configure_logger()
         try:
             # 第一步：复制原文档生成副本（输出目录）
             print("第一步：复制原文档生成副本...")
@@ -665,28 +977,47 @@ class Doc2ImageGenerator:
             
             # 第四步：并发生成提示词和图片
             print("第四步：并发生成提示词和图片...")
-            # 创建线程池（最大工作数=concurrent_workers）
-            with ThreadPoolExecutor(max_workers=self.concurrent_workers) as executor:
-                futures = []
-                # 遍历所有文本块，提交到线程池
-                for idx, chunk in enumerate(text_chunks):
-                    future = executor.submit(self._process_single_chunk, chunk, idx)
-                    futures.append(future)
+            # 提交任务前一次性加载SD模型（后续请求不再逐次指定模型）
+            self._apply_sd_options()
+            # 打开提示词txt文件（只打开一次，64KB缓冲，所有文本块共用）
+            self._txt_handle = open(self._txt_path, "w", encoding="utf-8", buffering=65536)
+            # 创建线程池：工作线程数为两个阶段的并发上限之和，
+            # 使部分线程等待SD出图时，其余线程可以继续请求OpenAI生成提示词
+            max_workers = self.openai_concurrency + self.sd_concurrency
+            # 进度条显示期间，本模块日志改由tqdm.write输出，避免日志行打断进度条
+            # （仅在日志由本模块配置时重定向；调用方自行配置的日志保持不变）
+            redirect = logging_redirect_tqdm(loggers=[logger]) if logger.handlers else contextlib.nullcontext()
+            with redirect, ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # 遍历所有文本块，提交到线程池（记录任务→文本块索引的映射）
+                future_map = {
+                    executor.submit(self._process_single_chunk, chunk, idx): idx
+                    for idx, chunk in enumerate(text_chunks)
+                }
                 
-                # 等待所有并发任务完成，捕获单个任务的异常
-                for future in futures:
+                # 按完成顺序等待任务（慢的文本块不会阻塞已完成任务的处理），捕获单个任务的异常
+                for future in tqdm(as_completed(future_map), total=len(future_map), desc="文本块处理进度"):
                     try:
                         future.result()
                     except Exception as e:
-                        print(f"单个文本块处理失败：{str(e)}")
+                        logger.error(f"文本块 {future_map[future]} 处理失败：{str(e)}")
+            
+            # 所有图片插入完成后，统一保存一次文档
+            self._doc.save(self.docx_copy_path)
             
             # 打印最终结果路径（输出目录）
             print(f"所有处理任务已完成！")
             print(f"👉 最终文档：{self.docx_copy_path}")
-            print(f"👉 提示词文件：{os.path.join(self.output_dir, f'{os.path.splitext(os.path.basename(self.docx_path))[0]}_prompts.txt')}")
-            print(f"👉 生成的图片均保存在：{self.output_dir}")
+            print(f"👉 提示词文件：{self._txt_path}")
+            if self.save_images_to_disk:
+                print(f"👉 生成的图片均保存在：{self.output_dir}")
         
         # 捕获主流程异常，打印并重新抛出
         except Exception as e:
             print(f"主流程执行失败：{str(e)}")
-            raise
\ No newline at end of file
+            raise
+        # 无论成功与否都刷新并关闭提示词文件、释放连接池
+        finally:
+            if self._txt_handle is not None:
+                self._txt_handle.close()
+                self._txt_handle = None
+            self.close()
\ No newline at end of file